@@ -1,13 +1,19 @@
 """Conversion module for equi_ref blood conversion."""
 
-from typing import Set
+import shutil
+from io import BytesIO
+from typing import BinaryIO, Set
 from logging import Logger, FileHandler
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pa_compute
 
 RECRUITING_PREFIX: str = "rekrutierung_"
 QUESTIONNAIRE_PREFIX: str = "befragung_"
+KEY_COLUMNS: Set[str] = {"pat_id", "redcap_event_name"}
 
 
 def read_dataframe_from_file(
@@ -29,11 +35,15 @@ def read_dataframe_from_file(
     """
     match file_path.suffix:
         case ".xlsx":
-            return pd.read_excel(file_path, engine="openpyxl")
+            return pd.read_excel(file_path, engine="calamine", dtype_backend="pyarrow")
         case ".tsv":
-            return pd.read_csv(file_path, sep="\t")
+            return pd.read_csv(
+                file_path, sep="\t", engine="pyarrow", dtype_backend="pyarrow"
+            )
         case ".csv":
-            return pd.read_csv(file_path, sep=separator)
+            return pd.read_csv(
+                file_path, sep=separator, engine="pyarrow", dtype_backend="pyarrow"
+            )
         case _:
             raise ValueError(
                 (
@@ -43,33 +53,85 @@ def read_dataframe_from_file(
             )
 
 
-def write_dataframe_to_file(
+def write_dataframe_to_csv(
     df: pd.DataFrame,
-    file_path: Path,
+    output: Path | BinaryIO,
+    separator: str,
 ):
     """
-    Writes a DataFrame to a file based on its extension.
+    Writes a DataFrame as CSV.
+    Datetime columns with pyarrow backed dtypes are converted to numpy datetimes first,
+    so pandas writes plain dates (e.g. `2023-01-01`) if the values have no time.
     Parameters
     ----------
     df : pd.DataFrame
-        DataFrame to write to the file.
-    file_path : Path
-        Path to the output file.
+        DataFrame to write.
+    output : Path | BinaryIO
+        Path to the output file or binary buffer to write to.
+    separator : str
+        Separator to use between the columns.
     """
-    match file_path.suffix:
+    datetime_columns = {
+        col: f"datetime64[{dtype.pyarrow_dtype.unit}]"
+        for col, dtype in df.dtypes.items()
+        if isinstance(dtype, pd.ArrowDtype)
+        and pa.types.is_timestamp(dtype.pyarrow_dtype)
+        and dtype.pyarrow_dtype.tz is None
+    }
+    if len(datetime_columns) > 0:
+        df = df.astype(datetime_columns)
+    df.to_csv(output, sep=separator, index=False)
+
+
+def serialize_dataframe(
+    df: pd.DataFrame,
+    file_suffix: str,
+) -> bytes:
+    """
+    Serializes a DataFrame into the file format of the given extension.
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame to serialize.
+    file_suffix : str
+        File extension of the format, e.g. `.xlsx`.
+    Returns
+    -------
+    bytes
+        Content of the file.
+    """
+    buffer = BytesIO()
+    match file_suffix:
         case ".xlsx":
-            df.to_excel(file_path, index=False)
+            df.to_excel(buffer, index=False, engine="xlsxwriter")
         case ".tsv":
-            df.to_csv(file_path, sep="\t", index=False)
+            write_dataframe_to_csv(df, buffer, "\t")
         case ".csv":
-            df.to_csv(file_path, index=False)
+            write_dataframe_to_csv(df, buffer, ",")
         case _:
             raise ValueError(
                 (
-                    f"Unsupported output file format: {file_path.suffix}. "
+                    f"Unsupported output file format: {file_suffix}. "
                     "Supported formats are .xlsx, .tsv, .csv"
                 )
             )
+    return buffer.getvalue()
+
+
+def write_dataframe_to_file(
+    df: pd.DataFrame,
+    file_path: Path,
+):
+    """
+    Writes a DataFrame to a file based on its extension.
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame to write to the file.
+    file_path : Path
+        Path to the output file.
+    """
+    file_path.write_bytes(serialize_dataframe(df, file_path.suffix))
 
 
 def conversion(
@@ -95,17 +157,18 @@ def conversion(
         Logger instance for logging messages.
     """
 
+    output_dir = output_file.parent
+    log_file = output_dir / f"{output_file.stem}.log"
+    backup_file = output_dir / f"{output_file.stem}.backup{output_file.suffix}"
+
     # checks
     if not patient_file.is_file():
         raise FileNotFoundError(f"Patient file {patient_file} does not exist.")
 
-    if not output_file.parent.is_dir():
-        raise NotADirectoryError(
-            f"Output directory {output_file.parent} does not exist."
-        )
+    if not output_dir.is_dir():
+        raise NotADirectoryError(f"Output directory {output_dir} does not exist.")
 
     # attatch file handler to logger temporarily
-    log_file = output_file.with_suffix(".log")
     logger.info("Logging to %s", log_file)
     logging_file_handler = FileHandler(log_file, encoding="utf-8", mode="w")
     logger.addHandler(logging_file_handler)
@@ -116,64 +179,100 @@ def conversion(
         logger.error("%s", e)
         return
 
-    patient_ids = df["pat_id"].unique().tolist()
+    # Reduce the data to the whitelisted columns upfront, so the following steps
+    # do not copy columns which are dropped anyway. The key columns are needed
+    # for the merge and are removed at the end if they are not whitelisted.
+    if len(column_whitelist) > 0:
+        df = df[
+            [col for col in df.columns if col in column_whitelist or col in KEY_COLUMNS]
+        ]
 
-    updated_questionnaire_dfs = []
+    # Sort the rows by patient (keeping the order of first appearance) once,
+    # so the rows of each patient are contiguous in all following steps.
+    # Patients are identified by their integer codes from here on,
+    # rows without patient ID (code -1) are dropped.
+    patient_codes, patient_ids = pd.factorize(df["pat_id"])
+    rows_without_patient_id = np.count_nonzero(patient_codes == -1)
+    if rows_without_patient_id > 0:
+        logger.warning(
+            "Found %d rows without patient ID. Skipping.", rows_without_patient_id
+        )
+    patient_row_order = np.argsort(patient_codes, kind="stable")
+    patient_row_order = patient_row_order[patient_codes[patient_row_order] != -1]
+    patient_codes = patient_codes[patient_row_order]
+    df = df.iloc[patient_row_order].reset_index(drop=True)
 
-    for patient_id in patient_ids:
-        logger.info("Processing patient ID: %s", patient_id)
+    # event type masks are computed once for all rows using Arrow's string kernels,
+    # which work directly on the Arrow buffers. Missing event names match neither.
+    event_names = pa.array(df["redcap_event_name"])
+    is_recruiting = (
+        pa_compute.starts_with(event_names, RECRUITING_PREFIX)
+        .fill_null(False)
+        .to_numpy(zero_copy_only=False)
+    )
+    is_questionnaire = (
+        pa_compute.starts_with(event_names, QUESTIONNAIRE_PREFIX)
+        .fill_null(False)
+        .to_numpy(zero_copy_only=False)
+    )
 
-        patient_df = df[df["pat_id"] == patient_id]
-        recruiting_row = patient_df[
-            patient_df["redcap_event_name"].str.startswith(RECRUITING_PREFIX)
-        ]
-        if recruiting_row.empty:
-            logger.warning(
-                "No recruiting data found for patient ID: %s. Skipping.", patient_id
-            )
-            continue
+    logger.info("Processing %d patients", len(patient_ids))
 
-        if len(recruiting_row) > 1:
-            logger.warning(
-                "Multiple recruiting entries found for patient ID: %s. Using the first one.",
-                patient_id,
-            )
+    recruiting_counts = np.bincount(
+        patient_codes[is_recruiting], minlength=len(patient_ids)
+    )
+    for patient_id in patient_ids[recruiting_counts == 0]:
+        logger.warning(
+            "No recruiting data found for patient ID: %s. Skipping.", patient_id
+        )
+    for patient_id in patient_ids[recruiting_counts > 1]:
+        logger.warning(
+            "Multiple recruiting entries found for patient ID: %s. Using the first one.",
+            patient_id,
+        )
 
-        questionnaire_df = patient_df[
-            patient_df["redcap_event_name"].str.startswith(QUESTIONNAIRE_PREFIX)
-        ].copy(deep=True)
-
-        for col in questionnaire_df.columns:
-            if (
-                questionnaire_df[col].isnull().all()
-                and not recruiting_row[col].isnull().all()
-            ):
-                questionnaire_df.fillna(
-                    {col: recruiting_row.iloc[0][col]}, inplace=True
-                )
+    is_questionnaire &= recruiting_counts[patient_codes] > 0
 
-        if len(column_whitelist) > 0:
-            existing_columns = set(questionnaire_df.columns)
-            columns_to_drop = existing_columns - column_whitelist
-            questionnaire_df.drop(columns=columns_to_drop, inplace=True)
+    recruiting_df = df[is_recruiting].drop(columns="pat_id")
+    recruiting_codes = patient_codes[is_recruiting]
+    questionnaire_df = df[is_questionnaire]
+    questionnaire_codes = patient_codes[is_questionnaire]
 
-        updated_questionnaire_dfs.append(questionnaire_df)
+    # Fill columns which are empty in all questionnaire rows of a patient
+    # with the values of the patient's (first) recruiting row.
+    # Both are determined once per patient (patients x columns) and only the
+    # resulting fill values are broadcasted to the questionnaire rows.
+    is_empty_column = (
+        questionnaire_df.drop(columns="pat_id")
+        .isnull()
+        .groupby(questionnaire_codes, sort=False)
+        .all()
+    )
+    # rows are sorted by patient, so the first row of a patient is where the code changes
+    is_first_recruiting_row = np.diff(recruiting_codes, prepend=-1) != 0
+    first_recruiting_rows = recruiting_df[is_first_recruiting_row].set_axis(
+        recruiting_codes[is_first_recruiting_row]
+    )
+    fill_values = (
+        first_recruiting_rows.where(is_empty_column)
+        .reindex(questionnaire_codes)
+        .set_axis(questionnaire_df.index)
+    )
+    df = questionnaire_df.fillna(fill_values).reset_index(drop=True)
 
-    df = pd.concat(updated_questionnaire_dfs, ignore_index=True)
+    if len(column_whitelist) > 0:
+        df.drop(columns=KEY_COLUMNS - column_whitelist, inplace=True)
 
     # Convert height from cm to m. Considering no human is taller than 3 meters and not NaN
     if "pat_height" in df.columns:
-        df["pat_height"] = df["pat_height"].apply(
-            lambda x: x / 100.0 if x is not pd.NA and x > 3.0 else x
-        )
+        # cast first, so heights given as integer centimeters can hold the meters
+        pat_height = df["pat_height"].astype("double[pyarrow]")
+        is_centimeter = pat_height.gt(3.0).fillna(False)
+        df["pat_height"] = pat_height.mask(is_centimeter, pat_height / 100.0)
 
     if output_file.is_file():
         existing_df = read_dataframe_from_file(output_file, ",")
-        columns_of_existing_df = list(existing_df.columns)
-        columns_of_existing_df.sort()
-        columns_of_new_df = list(df.columns)
-        columns_of_new_df.sort()
-        if columns_of_existing_df != columns_of_new_df:
+        if frozenset(existing_df.columns) != frozenset(df.columns):
             logger.error(
                 "The output file %s already exists and has different columns. Cannot append. Abort.",
                 str(output_file),
@@ -183,21 +282,47 @@ def conversion(
                 "The output file %s already exists with the same columns. Appending and remove duplicates keeping the first one.",
                 str(output_file),
             )
-            backup_file_suffix = output_file.suffix
-            backup_file = output_file.with_suffix(f".backup.{backup_file_suffix}")
-            logger.info("Backing up existing file to %s", str(backup_file))
-            existing_df.to_excel(backup_file, index=False)
+            # Align the dtypes before appending. Columns without any values are read
+            # with the pyarrow null dtype and take the dtype of the other frame.
+            for col in df.columns:
+                if existing_df[col].dtype == df[col].dtype:
+                    continue
+                if existing_df[col].isna().all():
+                    existing_df[col] = existing_df[col].astype(df[col].dtype)
+                elif df[col].isna().all():
+                    df[col] = df[col].astype(existing_df[col].dtype)
 
-            df = pd.concat([existing_df, df], ignore_index=True)
-            df.drop_duplicates(inplace=True)
+            df = pd.concat([existing_df, df], ignore_index=True, copy=False)
+            # Rows are identified by the key columns, if they are part of the output.
+            # Otherwise fall back to comparing whole rows.
+            duplicate_subset = None
+            if KEY_COLUMNS.issubset(df.columns):
+                duplicate_subset = sorted(KEY_COLUMNS)
+            df.drop_duplicates(
+                subset=duplicate_subset, keep="first", inplace=True, ignore_index=True
+            )
 
             try:
-                write_dataframe_to_file(df, output_file)
-                logger.info(
-                    "Appended data written to %s successfully.", str(output_file)
-                )
+                merged_data = serialize_dataframe(df, output_file.suffix)
             except ValueError as e:
                 logger.error("%s", e)
+            else:
+                # Re-running the conversion on the same patient file does not add
+                # any rows, so the output file is only rewritten if it changes.
+                # xlsx files embed their creation time (in seconds), so they are
+                # only detected as unchanged if written within the same second,
+                # otherwise they are backed up and rewritten.
+                if merged_data == output_file.read_bytes():
+                    logger.info(
+                        "The output file %s is already up to date.", str(output_file)
+                    )
+                else:
+                    logger.info("Backing up existing file to %s", str(backup_file))
+                    shutil.copyfile(output_file, backup_file)
+                    output_file.write_bytes(merged_data)
+                    logger.info(
+                        "Appended data written to %s successfully.", str(output_file)
+                    )
 
     else:
         logger.info("Writing merged data to %s", str(output_file))
@@ -1,12 +1,17 @@
 """Graphical user interface for the conversion tool."""
 
 from pathlib import Path
+from queue import Empty, Queue
+from typing import List
 from logging import Logger, Handler as LoggingHandler
 from tkinter import Tk, filedialog, ttk, StringVar, END
 import tkinter.scrolledtext as ScrolledText
 
 from diverso_conversion.conversion import conversion
 
+LOGGER_WIDGET_INSERT_INTERVAL: int = 50  # milliseconds
+LOGGER_WIDGET_MAX_BATCH_SIZE: int = 500
+
 
 class Gui:
     """Tk based GUI for the conversion tool."""
@@ -188,10 +193,27 @@ class LoggerWidget(LoggingHandler):
         LoggingHandler.__init__(self, level=level)
         self.widget = widget
         self.widget.config(state="disabled")
+        self.message_queue: Queue[str] = Queue()
+        self.widget.after(LOGGER_WIDGET_INSERT_INTERVAL, self.insert_queued_messages)
 
     def emit(self, record):
-        self.widget.config(state="normal")
-        # Append message (record) to the widget
-        self.widget.insert(END, self.format(record) + "\n")
-        self.widget.see(END)  # Scroll to the bottom
-        self.widget.config(state="disabled")
+        # Each insert triggers a layout of the widget, so messages are only queued
+        # here and inserted in batches by insert_queued_messages.
+        self.message_queue.put_nowait(self.format(record))
+
+    def insert_queued_messages(self):
+        """Appends the queued messages to the widget and schedules the next run."""
+        messages: List[str] = []
+        while len(messages) < LOGGER_WIDGET_MAX_BATCH_SIZE:
+            try:
+                messages.append(self.message_queue.get_nowait())
+            except Empty:
+                break
+
+        if len(messages) > 0:
+            self.widget.config(state="normal")
+            self.widget.insert(END, "\n".join(messages) + "\n")
+            self.widget.see(END)  # Scroll to the bottom
+            self.widget.config(state="disabled")
+
+        self.widget.after(LOGGER_WIDGET_INSERT_INTERVAL, self.insert_queued_messages)